@@ -0,0 +1,431 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ASGI entry point that serves the proxy over HTTP/1.1 and HTTP/2 (h2c on
+cleartext connections, h2 via ALPN with TLS), and adds a WebSocket endpoint
+that multiplexes many streaming completions over one connection.
+
+    python asgi.py
+    python asgi.py --certfile cert.pem --keyfile key.pem
+
+Requires hypercorn (`pip install -r requirements-asgi.txt`).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs
+
+try:
+    from hypercorn.app_wrappers import WSGIWrapper
+except ImportError:
+    print(
+        "HTTP/2 and WebSocket serving requires hypercorn. Install it with `pip install -r requirements-asgi.txt`."
+    )
+    sys.exit(1)
+
+from lib.logs import AccessLog
+from lib.scheduler import PRIORITY_INTERACTIVE, QueueTimeout, RateLimited
+from server import (
+    DEFAULT_MODEL,
+    ModelNotFound,
+    app as flask_app,
+    convert_messages_to_prompt,
+    generate_chat_completion_chunks,
+    get_model_mapping,
+    resolve_kagi_models,
+    scheduler,
+    tenant_registry,
+)
+
+WS_PATH = "/v1/ws"
+# Frames buffered per WebSocket connection before completions are paused
+WS_SEND_QUEUE_SIZE = 256
+
+# Largest request body accepted, prompts can be several megabytes
+MAX_BODY_SIZE = int(os.environ.get("KAGI_MAX_BODY_SIZE", 32 * 1024 * 1024))
+# Threads running WSGI requests
+HTTP_THREADS = int(os.environ.get("KAGI_HTTP_THREADS", 64))
+# Threads running WebSocket completions, kept apart so sockets cannot starve HTTP
+WS_THREADS = int(os.environ.get("KAGI_WS_THREADS", 32))
+# Concurrent completions allowed on one WebSocket connection
+WS_MAX_COMPLETIONS = int(os.environ.get("KAGI_WS_MAX_COMPLETIONS", 8))
+# Seconds a completion may wait for a window_update before it is ended
+WS_WINDOW_TIMEOUT = float(os.environ.get("KAGI_WS_WINDOW_TIMEOUT", 60))
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class WindowTimeout(Exception):
+    """The client did not grant more window in time."""
+
+
+class CompletionStream:
+    """
+    One completion multiplexed over a WebSocket connection.
+
+    When the client asks for flow control, `window` is the number of chunks
+    it is still willing to receive; the producing thread waits for a
+    `window_update` once it reaches zero. Otherwise `window` is None and only
+    the per-connection send queue applies back-pressure.
+    """
+
+    def __init__(self, stream_id, window=None):
+        self.id = stream_id
+        self.window = window
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def add_window(self, increment):
+        with self._cond:
+            if self.window is not None:
+                self.window += increment
+                self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def wait_for_window(self, timeout=WS_WINDOW_TIMEOUT):
+        """
+        Take one unit of window. Returns False if the stream was cancelled and
+        raises WindowTimeout if no window was granted within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.window is not None and self.window <= 0 and not self.cancelled:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WindowTimeout(
+                        f"No window_update received within {timeout:g} seconds"
+                    )
+                self._cond.wait(remaining)
+            if self.cancelled:
+                return False
+            if self.window is not None:
+                self.window -= 1
+            return True
+
+
+class CompletionSocket:
+    """
+    Serves chat completions over one WebSocket connection.
+
+    Client messages (JSON text frames):
+        {"type": "completion.create", "id": "<id>", "request": {...}, "window": 16}
+        {"type": "window_update", "id": "<id>", "increment": 16}
+        {"type": "completion.cancel", "id": "<id>"}
+
+    Server messages:
+        {"type": "completion.chunk", "id": "<id>", "chunk": {...}}
+        {"type": "completion.done", "id": "<id>"}
+        {"type": "completion.error", "id": "<id>", "error": {...}}
+
+    `request` is a /v1/chat/completions body; it is always streamed. `window`
+    is optional and enables per-completion flow control. `id` is a string or
+    an integer, and at most `WS_MAX_COMPLETIONS` completions may run at once.
+    """
+
+    def __init__(self, send, loop, executor, tenant):
+        self._send = send
+        self._loop = loop
+        self._executor = executor
+        self._tenant = tenant
+        self._outgoing = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self._streams = {}
+        self._closed = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def run(self, receive):
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message["type"] == "websocket.receive":
+                    await self._handle(message.get("text") or message.get("bytes"))
+        finally:
+            self._closed = True
+            for stream in list(self._streams.values()):
+                stream.cancel()
+            # Keep draining frames until every producer thread has exited
+            await self._idle.wait()
+            sender.cancel()
+
+    async def _send_loop(self):
+        while True:
+            frame = await self._outgoing.get()
+            if self._closed:
+                continue
+            try:
+                await self._send({"type": "websocket.send", "text": json.dumps(frame)})
+            except Exception:
+                self._closed = True
+
+    async def _handle(self, raw):
+        try:
+            message = json.loads(raw)
+            message_type = message["type"]
+            stream_id = message["id"]
+        except (TypeError, ValueError, KeyError):
+            stream_id = None
+        if not isinstance(stream_id, str) and not _is_int(stream_id):
+            await self._outgoing.put(
+                {
+                    "type": "completion.error",
+                    "id": None,
+                    "error": {
+                        "message": "Messages must be JSON objects with a type and a string or integer id",
+                        "type": "invalid_request_error",
+                        "code": "invalid_message",
+                    },
+                }
+            )
+            return
+
+        stream = self._streams.get(stream_id)
+        if message_type == "completion.create":
+            if stream is not None:
+                await self._outgoing.put(
+                    self._error(stream_id, "Duplicate completion id", "duplicate_id")
+                )
+                return
+            window = message.get("window")
+            if window is not None and (not _is_int(window) or window < 0):
+                await self._outgoing.put(
+                    self._error(stream_id, "window must be a non-negative integer", "invalid_window")
+                )
+                return
+            if len(self._streams) >= WS_MAX_COMPLETIONS:
+                await self._outgoing.put(
+                    self._error(
+                        stream_id,
+                        f"At most {WS_MAX_COMPLETIONS} completions may run on one connection",
+                        "too_many_completions",
+                        "rate_limit_error",
+                    )
+                )
+                return
+            request = message.get("request")
+            if request is None:
+                request = {}
+            if not isinstance(request, dict):
+                await self._outgoing.put(
+                    self._error(stream_id, "request must be a JSON object", "invalid_request")
+                )
+                return
+            stream = CompletionStream(stream_id, window)
+            self._streams[stream_id] = stream
+            self._idle.clear()
+            self._executor.submit(self._run_completion, stream, request)
+        elif message_type == "window_update" and stream is not None:
+            increment = message.get("increment", 0)
+            if not _is_int(increment) or increment < 0:
+                await self._outgoing.put(
+                    self._error(
+                        stream_id, "increment must be a non-negative integer", "invalid_window"
+                    )
+                )
+                return
+            stream.add_window(increment)
+        elif message_type == "completion.cancel" and stream is not None:
+            stream.cancel()
+
+    @staticmethod
+    def _error(stream_id, message, code, error_type="invalid_request_error"):
+        return {
+            "type": "completion.error",
+            "id": stream_id,
+            "error": {"message": message, "type": error_type, "code": code},
+        }
+
+    def _emit(self, frame):
+        """Queue a frame from a producer thread, blocking while the queue is full."""
+        asyncio.run_coroutine_threadsafe(self._outgoing.put(frame), self._loop).result()
+
+    def _finished(self, stream_id):
+        self._streams.pop(stream_id, None)
+        if not self._streams:
+            self._idle.set()
+
+    def _run_completion(self, stream, data):
+        access_log = AccessLog("WS", WS_PATH)
+        access_log.tenant = self._tenant.name
+        access_log.stream = True
+        try:
+            messages = data.get("messages", [])
+            if not messages:
+                access_log.status = 400
+                self._emit(
+                    self._error(stream.id, "messages is required", "missing_required_parameter")
+                )
+                return
+
+            requested_model = data.get("model", DEFAULT_MODEL)
+            if not isinstance(requested_model, str):
+                access_log.status = 400
+                self._emit(self._error(stream.id, "model must be a string", "invalid_model"))
+                return
+            access_log.model = requested_model
+            try:
+                kagi_models = resolve_kagi_models(requested_model)
+            except ModelNotFound as e:
+                access_log.status = 400
+                self._emit(self._error(stream.id, str(e), "model_not_found"))
+                return
+            chunk_model = data.get("model", get_model_mapping().get(DEFAULT_MODEL))
+            prompt = convert_messages_to_prompt(messages)
+
+            try:
+                ticket = scheduler.acquire(self._tenant, PRIORITY_INTERACTIVE)
+            except RateLimited as e:
+                access_log.status = 429
+                self._emit(
+                    self._error(stream.id, str(e), "rate_limit_exceeded", "rate_limit_error")
+                )
+                return
+            except QueueTimeout as e:
+                access_log.status = 503
+                self._emit(self._error(stream.id, str(e), "server_overloaded", "api_error"))
+                return
+
+            access_log.status = 200
+            chunks = generate_chat_completion_chunks(
+                prompt, kagi_models, chunk_model, ticket, access_log
+            )
+            try:
+                for chunk in chunks:
+                    if "error" in chunk:
+                        self._emit(
+                            {"type": "completion.error", "id": stream.id, "error": chunk["error"]}
+                        )
+                        return
+                    try:
+                        has_window = stream.wait_for_window()
+                    except WindowTimeout as e:
+                        # Closing the chunks below releases the scheduler slot
+                        access_log.error = str(e)
+                        self._emit(self._error(stream.id, str(e), "flow_control_timeout"))
+                        return
+                    if not has_window:
+                        access_log.error = "cancelled"
+                        return
+                    self._emit({"type": "completion.chunk", "id": stream.id, "chunk": chunk})
+            finally:
+                chunks.close()
+            self._emit({"type": "completion.done", "id": stream.id})
+        except Exception as e:
+            access_log.error = str(e)
+            if not self._closed:
+                self._emit(self._error(stream.id, str(e), "internal_error", "api_error"))
+        finally:
+            access_log.finish()
+            self._loop.call_soon_threadsafe(self._finished, stream.id)
+
+
+class ProxyApp:
+    """
+    ASGI application: WebSocket completions on /v1/ws, everything else is
+    handed to the Flask app. WSGI requests run on a dedicated thread pool so
+    long-lived streams are not limited by asyncio's small default executor.
+    WebSocket completions, which hold a thread while queued by the scheduler,
+    get a pool of their own so they cannot stall HTTP requests.
+    """
+
+    def __init__(
+        self,
+        wsgi_app,
+        max_body_size=MAX_BODY_SIZE,
+        threads=HTTP_THREADS,
+        ws_threads=WS_THREADS,
+    ):
+        self._wsgi = WSGIWrapper(wsgi_app, max_body_size)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="proxy")
+        self._ws_executor = ThreadPoolExecutor(
+            max_workers=ws_threads, thread_name_prefix="proxy-ws"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket" and scope["path"] == WS_PATH:
+            await self._websocket(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+
+        def call_soon(func, *args):
+            return asyncio.run_coroutine_threadsafe(func(*args), loop).result()
+
+        await self._wsgi(
+            scope, receive, send, partial(loop.run_in_executor, self._executor), call_soon
+        )
+
+    async def _websocket(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+
+        # Browsers cannot set headers on a WebSocket, so also accept ?api_key=
+        headers = dict(scope["headers"])
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        api_key = parse_qs(scope.get("query_string", b"").decode()).get("api_key")
+        if api_key:
+            authorization = f"Bearer {api_key[0]}"
+        tenant = tenant_registry.identify(authorization)
+        if tenant is None:
+            await send({"type": "websocket.close", "code": 4401})
+            return
+
+        await send({"type": "websocket.accept"})
+        socket = CompletionSocket(send, asyncio.get_running_loop(), self._ws_executor, tenant)
+        await socket.run(receive)
+
+
+app = ProxyApp(flask_app)
+
+
+def main():
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5000)))
+    parser.add_argument("--certfile", help="TLS certificate, enables h2 over TLS")
+    parser.add_argument("--keyfile", help="TLS private key")
+    args = parser.parse_args()
+
+    config = Config()
+    config.bind = [f"{args.host}:{args.port}"]
+    if args.certfile:
+        config.certfile = args.certfile
+        config.keyfile = args.keyfile
+    asyncio.run(serve(app, config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Run the hot-path benchmarks and compare them with a stored baseline.
+
+    python -m benchmarks --save-baseline    # on the base branch
+    python -m benchmarks                    # after a change, fails on regression
+
+Reports operations per second, the peak memory allocated during one call, the
+number of memory blocks one call allocates and the number of blocks still
+allocated after it (a leak indicator).
+Baselines are machine-specific and are not committed.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from benchmarks.hotpaths import CASES
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), ".baseline.json")
+ROUNDS = 5
+# Peak memory may grow by this much on top of the threshold before failing
+PEAK_SLACK_KIB = 4
+# Allocated and retained blocks may grow by this many on top of the threshold
+ALLOC_SLACK_BLOCKS = 8
+RETAINED_SLACK_BLOCKS = 2
+
+
+def measure_speed(fn, min_time: float) -> float:
+    """
+    Return the best operations per second over several rounds. The best
+    round is the least disturbed by other load on the machine, which makes it
+    more repeatable than the mean or median.
+    """
+    # Calibrate the number of calls per round
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / ROUNDS:
+            break
+        calls *= 2
+
+    rates = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        rates.append(calls / (time.perf_counter() - start))
+    return max(rates)
+
+
+def count_allocations(before, after) -> int:
+    """
+    Blocks allocated between two tracemalloc snapshots, counted per source
+    line so that frees elsewhere do not cancel them out. Blocks allocated and
+    freed again between the snapshots are not seen, so this is a lower bound.
+    """
+    stats = after.compare_to(before, "lineno")
+    return sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+
+
+def measure_memory(
+    fn, calls: int = 20, retained_calls: int = 20
+) -> tuple[float, float, float]:
+    """
+    Return (peak KiB allocated during one call, blocks allocated per call,
+    blocks retained per call). Retained blocks are averaged over
+    `retained_calls` calls so that background work still holding a few
+    blocks, such as queued log records, is spread thin.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(calls):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - current)
+
+        # Collection is disabled so garbage still counts as allocated
+        allocations = []
+        gc.disable()
+        try:
+            for _ in range(5):
+                gc.collect()
+                before = tracemalloc.take_snapshot()
+                fn()
+                allocations.append(count_allocations(before, tracemalloc.take_snapshot()))
+        finally:
+            gc.enable()
+    finally:
+        tracemalloc.stop()
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in range(retained_calls):
+        fn()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks) / retained_calls
+    return max(peaks) / 1024, min(allocations), retained
+
+
+def run(names, min_time: float) -> dict[str, dict[str, float]]:
+    results = {}
+    print(f"{'case':<30} {'ops/sec':>12} {'peak KiB':>10} {'allocs':>8} {'retained':>8}")
+    for name in names:
+        fn = CASES[name]
+        fn()  # warm up caches and imports
+        ops = measure_speed(fn, min_time)
+        # About a fifth of a second of calls, within limits
+        retained_calls = min(1000, max(20, int(ops / 5)))
+        peak, allocs, retained = measure_memory(fn, retained_calls=retained_calls)
+        results[name] = {
+            "ops_per_sec": round(ops, 2),
+            "peak_kib": round(peak, 2),
+            "alloc_blocks": allocs,
+            "retained_blocks": round(retained, 2),
+        }
+        print(f"{name:<30} {ops:>12.1f} {peak:>10.1f} {allocs:>8} {retained:>8.1f}")
+    return results
+
+
+def compare(results, baseline, threshold: float) -> list[str]:
+    """Return a description of every regression beyond `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        min_ops = base["ops_per_sec"] * (1 - threshold)
+        if result["ops_per_sec"] < min_ops:
+            change = result["ops_per_sec"] / base["ops_per_sec"] - 1
+            regressions.append(
+                f"{name}: {result['ops_per_sec']:.1f} ops/sec vs baseline "
+                f"{base['ops_per_sec']:.1f} ({change:+.0%})"
+            )
+        max_peak = base["peak_kib"] * (1 + threshold) + PEAK_SLACK_KIB
+        if result["peak_kib"] > max_peak:
+            regressions.append(
+                f"{name}: peak {result['peak_kib']:.1f} KiB vs baseline "
+                f"{base['peak_kib']:.1f} KiB"
+            )
+        # Baselines saved before allocation counts were measured lack them
+        if "alloc_blocks" in base:
+            max_allocs = base["alloc_blocks"] * (1 + threshold) + ALLOC_SLACK_BLOCKS
+            if result["alloc_blocks"] > max_allocs:
+                regressions.append(
+                    f"{name}: {result['alloc_blocks']} blocks allocated per call vs "
+                    f"baseline {base['alloc_blocks']}"
+                )
+        max_retained = (
+            max(base["retained_blocks"], 0) * (1 + threshold) + RETAINED_SLACK_BLOCKS
+        )
+        if result["retained_blocks"] > max_retained:
+            regressions.append(
+                f"{name}: {result['retained_blocks']:.1f} blocks retained per call vs "
+                f"baseline {base['retained_blocks']:.1f}"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument(
+        "-k", dest="filter", help="only run cases whose name contains this string"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="allowed relative regression before failing (default: 0.2)",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=1.0,
+        help="seconds spent timing each case (default: 1.0)",
+    )
+    args = parser.parse_args(argv)
+
+    names = [n for n in CASES if not args.filter or args.filter in n]
+    results = run(names, args.min_time)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\nRegressions beyond {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
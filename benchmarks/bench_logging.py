@@ -0,0 +1,89 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Per-request logging overhead: the old synchronous `print(prompt)` compared
+with the queue-backed structured logging in lib/logs.py.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_logging
+"""
+
+import logging
+import tempfile
+import time
+
+from lib import logs
+
+PROMPT_SIZES = [1_000, 100_000, 2_000_000]
+ITERATIONS = 200
+
+
+def bench(fn, iterations=ITERATIONS) -> float:
+    """Return the mean time per call in microseconds."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    # Log records go to a real file, like stdout redirected by a process manager
+    sink = tempfile.TemporaryFile("w")
+    logs.configure_logging(sink)
+    query_logger = logging.getLogger("SERVER").getChild("STREAM")
+
+    def structured_request(prompt):
+        if query_logger.isEnabledFor(logging.DEBUG):
+            query_logger.debug(
+                "Sending prompt", extra={"fields": logs.summarize_prompt(prompt)}
+            )
+        access_log = logs.AccessLog("POST", "/v1/chat/completions")
+        access_log.model = "openai/gpt-5-mini"
+        access_log.stream = True
+        access_log.status = 200
+        access_log.record_output("hello")
+        access_log.finish()
+
+    print(f"{'prompt':>10} {'print(prompt)':>16} {'structured':>16}")
+    for size in PROMPT_SIZES:
+        prompt = "x" * size
+
+        def print_request():
+            print(prompt, file=sink)
+
+        old = bench(print_request)
+        new = bench(lambda: structured_request(prompt))
+        print(f"{size:>10} {old:>13.1f} us {new:>13.1f} us")
+
+    for mode in ("truncated", "full"):
+        logs.LOG_PROMPTS = mode
+        logging.getLogger().setLevel(logging.DEBUG)
+        prompt = "x" * PROMPT_SIZES[-1]
+        cost = bench(lambda: structured_request(prompt))
+        print(f"KAGI_LOG_PROMPTS={mode} at DEBUG, {len(prompt)} chars: {cost:.1f} us")
+
+    # Time for the background thread to drain the queue to the file
+    start = time.perf_counter()
+    logs.stop_logging()
+    print(f"Draining queued records: {(time.perf_counter() - start) * 1e3:.1f} ms")
+    sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Time until a non-streaming reply is ready for large replies: the old
+aggregation over stream_query, which decodes every token and waits for the
+stream to close and the thread to be deleted, compared with complete_query.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_nonstream
+"""
+
+import json
+import time
+
+from benchmarks.fakes import large_stream_lines, offline_kagi
+from lib.query.query import complete_query, stream_query
+
+MODEL = "gpt-5-mini"
+REPEATS = [1, 10, 30]
+ITERATIONS = 5
+# Simulated time Kagi keeps the stream open after the reply and takes to delete the thread
+TAIL_LATENCY = 0.1
+DELETE_LATENCY = 0.1
+
+
+def aggregate_stream(prompt):
+    """The non-streaming path before complete_query."""
+    full_content = ""
+    for chunk in stream_query(prompt, MODEL):
+        chunk_data = json.loads(chunk[6:])
+        if chunk_data.get("type") == "token":
+            full_content += chunk_data.get("content", "")
+        elif chunk_data.get("type") == "final":
+            full_content = chunk_data.get("content", "")
+    return full_content
+
+
+def bench(fn, lines, iterations=ITERATIONS) -> float:
+    """Return the mean time until the reply is available in milliseconds."""
+    total = 0.0
+    with offline_kagi(lines, tail_latency=TAIL_LATENCY, delete_latency=DELETE_LATENCY):
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = fn("Hello")
+            total += time.perf_counter() - start
+            # complete_query leaves cleanup until after the response is sent
+            if isinstance(result, tuple):
+                result[1]()
+    return total / iterations * 1000
+
+
+def main():
+    print(f"{'reply chars':>12} {'stream_query':>15} {'complete_query':>15}")
+    for repeat in REPEATS:
+        lines = large_stream_lines(repeat)
+        with offline_kagi(lines):
+            reply, cleanup = complete_query("Hello", MODEL)
+            cleanup()
+        old = bench(aggregate_stream, lines)
+        new = bench(lambda prompt: complete_query(prompt, MODEL), lines)
+        print(f"{len(reply):>12} {old:>12.1f} ms {new:>12.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Replays the synthetic Kagi fixtures in place of the network.
+
+The fixtures follow the wire format of Kagi's /assistant/prompt stream and
+assistant page, but their content is generated (the reply is random words),
+so benchmark results are not real-traffic numbers.
+"""
+
+import contextlib
+import json
+import os
+import time
+from unittest import mock
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name: str, mode: str = "r"):
+    with open(os.path.join(FIXTURES_DIR, name), mode) as f:
+        return f.read()
+
+
+# Lines of a synthetic /assistant/prompt response, as yielded by iter_lines()
+STREAM_LINES = load_fixture("kagi_stream.bin", "rb").split(b"\n")
+ASSISTANT_PAGE = load_fixture("assistant.html")
+
+
+def large_stream_lines(repeat: int) -> list[bytes]:
+    """The synthetic stream with its reply repeated `repeat` times."""
+    token_indexes = [
+        i for i, line in enumerate(STREAM_LINES) if line.startswith(b"tokens.json:")
+    ]
+    first, last = token_indexes[0], token_indexes[-1]
+    lines = STREAM_LINES[:first] + STREAM_LINES[first : last + 1] * repeat
+    for line in STREAM_LINES[last + 1 :]:
+        if line.startswith(b"new_message.json:"):
+            message = json.loads(line.decode().rstrip("\x00").split(":", 1)[1])
+            if message["state"] == "done":
+                message["reply"] *= repeat
+                message["md"] *= repeat
+                line = f"new_message.json:{json.dumps(message)}\x00".encode()
+        lines.append(line)
+    return lines
+
+
+def _is_done(line: bytes) -> bool:
+    return line.startswith(b"new_message.json:") and b'"state": "done"' in line
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, text="", lines=(), tail_latency=0):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+        self._lines = lines
+        self._tail_latency = tail_latency
+
+    def iter_lines(self):
+        for line in self._lines:
+            yield line
+            # Kagi keeps the stream open for a while after the reply is done
+            if self._tail_latency and _is_done(line):
+                time.sleep(self._tail_latency)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def offline_kagi(lines=STREAM_LINES, tail_latency=0, delete_latency=0):
+    """
+    Serve Kagi requests from the fixtures instead of the network.
+    `tail_latency` simulates the stream staying open after the reply is
+    done and `delete_latency` the time taken to delete the thread.
+    """
+
+    def fake_post(url, **kwargs):
+        if url.endswith("/assistant/prompt"):
+            return FakeResponse(lines=lines, tail_latency=tail_latency)
+        time.sleep(delete_latency)
+        return FakeResponse()
+
+    def fake_get(url, **kwargs):
+        return FakeResponse(text=ASSISTANT_PAGE)
+
+    post = mock.patch("lib.query.query.requests.post", fake_post)
+    get = mock.patch("lib.mapping.requests.get", fake_get)
+    with post, get:
+        yield
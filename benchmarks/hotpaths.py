@@ -0,0 +1,118 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark cases for the proxy's hot paths. Each case is a zero-argument
+callable performing one operation on the synthetic fixtures.
+"""
+
+import json
+import os
+
+from benchmarks.fakes import (
+    STREAM_LINES,
+    large_stream_lines,
+    load_fixture,
+    offline_kagi,
+)
+from lib import logs
+
+# server.py refuses to start without a session key and logs to stdout
+os.environ.setdefault("KAGI_SESSION_KEY", "benchmark")
+logs.configure_logging(open(os.devnull, "w"))
+
+import server  # noqa: E402
+from lib.mapping import get_latest_model_mapping  # noqa: E402
+from lib.query.parse import parse_kagi_sse_stream  # noqa: E402
+
+MESSAGES = json.loads(load_fixture("messages.json"))
+LAST_MESSAGE = MESSAGES[-1:]
+REQUEST_BODY = {"model": server.DEFAULT_MODEL, "messages": LAST_MESSAGE}
+
+_client = server.app.test_client()
+# Drop each stream's journal on the next request so retained memory only
+# reflects leaks, not journals waiting for a reconnect
+server.journals.ttl = 0
+
+
+def parse_stream():
+    for line in STREAM_LINES:
+        parse_kagi_sse_stream(line)
+
+
+def convert_messages():
+    server.convert_messages_to_prompt(MESSAGES)
+
+
+def completion_chunk():
+    server.create_chat_completion_chunk("token", server.DEFAULT_MODEL)
+
+
+def completion():
+    server.create_chat_completion("x" * 4000, server.DEFAULT_MODEL)
+
+
+def chat_completions_stream():
+    with offline_kagi():
+        response = _client.post(
+            "/v1/chat/completions", json={**REQUEST_BODY, "stream": True}
+        )
+        response.get_data()
+        response.close()
+
+
+def chat_completions_nonstream():
+    with offline_kagi():
+        response = _client.post("/v1/chat/completions", json=REQUEST_BODY)
+        response.get_data()
+        response.close()
+
+
+# A reply of about 18k tokens
+LARGE_STREAM_LINES = large_stream_lines(30)
+
+
+def chat_completions_nonstream_large():
+    with offline_kagi(LARGE_STREAM_LINES):
+        response = _client.post("/v1/chat/completions", json=REQUEST_BODY)
+        response.get_data()
+        response.close()
+
+
+def model_mapping():
+    with offline_kagi():
+        get_latest_model_mapping()
+
+
+def access_log():
+    access = logs.AccessLog("POST", "/v1/chat/completions")
+    access.model = server.DEFAULT_MODEL
+    access.status = 200
+    access.record_output("token")
+    access.finish()
+
+
+CASES = {
+    "parse_kagi_sse_stream": parse_stream,
+    "convert_messages_to_prompt": convert_messages,
+    "create_chat_completion_chunk": completion_chunk,
+    "create_chat_completion": completion,
+    "chat_completions_stream": chat_completions_stream,
+    "chat_completions_nonstream": chat_completions_nonstream,
+    "chat_completions_nonstream_large": chat_completions_nonstream_large,
+    "get_latest_model_mapping": model_mapping,
+    "access_log": access_log,
+}
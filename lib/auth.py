@@ -18,11 +18,21 @@ import threading
 from datetime import datetime
 from typing import Any, Optional
 
+from lib.state import get_state_backend
+
+# Keys used in the shared state backend
+SESSION_KEY = "kagi_session"
+SESSION_SEED_KEY = "kagi_session.seed"
+SESSION_UPDATED_KEY = "kagi_session.updated"
+
 
 class KagiSessionManager:
     """
     Thread-safe session manager for Kagi session keys.
     Ensures consistent session data across all threads.
+
+    The key itself lives in the shared state backend (see lib/state.py) so a
+    rotation observed by one worker process is picked up by all of them.
     """
 
     _instance = None
@@ -44,9 +54,8 @@ class KagiSessionManager:
 
         with self._lock:
             if not self._initialized:
-                self._session_key: Optional[str] = None
+                self._state = get_state_backend()
                 self._session_data: dict[str, Any] = {}
-                self._last_updated: Optional[datetime] = None
                 self._session_lock = (
                     threading.RLock()
                 )  # Reentrant lock for session operations
@@ -55,13 +64,12 @@ class KagiSessionManager:
     def get_session_key(self) -> Optional[str]:
         """
         Get the current session key.
-        Thread-safe getter for session key.
+        Thread-safe getter for session key. Reads do not take a lock.
 
         Returns:
             Optional[str]: The current session key or None if not set
         """
-        with self._session_lock:
-            return self._session_key
+        return self._state.get(SESSION_KEY)
 
     def set_session_key(self, key: str) -> None:
         """
@@ -72,8 +80,29 @@ class KagiSessionManager:
             key (str): The new session key
         """
         with self._session_lock:
-            self._session_key = key
-            self._last_updated = datetime.now()
+            self._state.set(SESSION_KEY, key)
+            self._state.set(SESSION_UPDATED_KEY, datetime.now().isoformat())
+
+    def seed_session_key(self, key: str) -> None:
+        """
+        Set the session key from configuration at worker startup.
+
+        Workers restart independently, so blindly setting the configured key
+        would overwrite a key that another worker has since rotated. The
+        configured key is only applied if it differs from the one the shared
+        state was last seeded with, or if no key is stored yet.
+
+        Args:
+            key (str): The configured session key
+        """
+        with self._session_lock:
+            if (
+                self._state.get(SESSION_SEED_KEY) == key
+                and self._state.get(SESSION_KEY) is not None
+            ):
+                return
+            self._state.set(SESSION_SEED_KEY, key)
+            self.set_session_key(key)
 
     def get_last_updated(self) -> Optional[datetime]:
         """
@@ -82,13 +111,12 @@ class KagiSessionManager:
         Returns:
             Optional[datetime]: Last update timestamp or None
         """
-        with self._session_lock:
-            return self._last_updated
+        last_updated = self._state.get(SESSION_UPDATED_KEY)
+        return datetime.fromisoformat(last_updated) if last_updated else None
 
     def __repr__(self) -> str:
         """String representation of the session manager."""
-        with self._session_lock:
-            return (
-                f"KagiSessionManager(has_key={self._session_key is not None}, "
-                f"last_updated={self._last_updated})"
-            )
+        return (
+            f"KagiSessionManager(has_key={self.get_session_key() is not None}, "
+            f"last_updated={self.get_last_updated()})"
+        )
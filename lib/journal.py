@@ -0,0 +1,271 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Iterator, Optional
+
+_logger = logging.getLogger("JOURNAL")
+
+
+class JournalTruncated(Exception):
+    """The requested events were dropped from the journal."""
+
+
+class CompletionJournal:
+    """
+    Ordered record of the SSE events of one streaming completion.
+
+    The completion is produced by a background thread that appends events
+    here, and any number of readers follow the journal from a given event
+    sequence number. This lets a client that lost its connection reconnect
+    with `Last-Event-ID`, replay what it missed and keep following the same
+    upstream generation.
+
+    At most `max_events` events are kept in memory. Older events are moved
+    to `spill_path` if one is set, otherwise they are dropped and can no
+    longer be replayed. Without a spill file, events that a connected reader
+    has not reached yet are never dropped. With a spill file, all events are
+    moved to it once the completion finishes.
+    """
+
+    def __init__(
+        self,
+        completion_id: str,
+        tenant: Optional[str],
+        max_events: int,
+        spill_path: Optional[str] = None,
+    ):
+        self.id = completion_id
+        self.tenant = tenant
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._max_events = max_events
+        self._spill_path = spill_path
+        self._events: deque[str] = deque()
+        # Sequence numbers of the events held in memory are [_first_seq, _next_seq)
+        self._first_seq = 0
+        self._next_seq = 0
+        # Position of every connected reader, keyed by reader
+        self._cursors: dict[object, int] = {}
+        self._cond = threading.Condition()
+
+    def append(self, data: str) -> int:
+        """Add an event and wake up readers. Returns its sequence number."""
+        with self._cond:
+            seq = self._next_seq
+            self._events.append(data)
+            self._next_seq += 1
+            if len(self._events) > self._max_events:
+                self._evict()
+            self._cond.notify_all()
+            return seq
+
+    def _evict(self) -> None:
+        # Evict down to half the limit so spilling happens in batches
+        count = len(self._events) - self._max_events // 2
+        if not self._spill_path and self._cursors:
+            count = min(count, min(self._cursors.values()) - self._first_seq)
+        if count > 0:
+            self._remove_events(count)
+
+    def _remove_events(self, count: int) -> None:
+        evicted = [self._events.popleft() for _ in range(count)]
+        if self._spill_path:
+            with open(self._spill_path, "a") as f:
+                # Events are single-line JSON, so one per line
+                f.writelines(event + "\n" for event in evicted)
+        self._first_seq += count
+
+    def finish(self) -> None:
+        with self._cond:
+            self.finished_at = time.time()
+            # Nothing is appended any more, readers can replay from the spill file
+            if self._spill_path and self._events:
+                self._remove_events(len(self._events))
+            self._cond.notify_all()
+
+    def can_replay_from(self, seq: int) -> bool:
+        with self._cond:
+            return seq >= self._first_seq or self._spill_path is not None
+
+    def _read_spilled(self, start: int, end: int) -> list[str]:
+        try:
+            with open(self._spill_path) as f:
+                return [line.rstrip("\n") for line in itertools.islice(f, start, end)]
+        except FileNotFoundError:
+            # The journal expired or was evicted from its store
+            raise JournalTruncated(f"Events from {start} are no longer available")
+
+    def read(self, seq: int, keepalive: float) -> Iterator[Optional[tuple[int, str]]]:
+        """
+        Yield (sequence number, event) pairs starting at `seq`, waiting for
+        new events until the completion finishes. Yields None whenever no
+        event arrived for `keepalive` seconds so the caller can check that
+        its client is still connected.
+
+        Raises:
+            JournalTruncated: If events from `seq` were dropped.
+        """
+        reader = object()
+        try:
+            yield from self._read(reader, seq, keepalive)
+        finally:
+            with self._cond:
+                self._cursors.pop(reader, None)
+                # Events kept for this reader may now be evicted
+                if len(self._events) > self._max_events:
+                    self._evict()
+
+    def _read(self, reader, seq, keepalive):
+        while True:
+            spilled_until = None
+            with self._cond:
+                self._cursors[reader] = seq
+                if seq < self._first_seq:
+                    if self._spill_path is None:
+                        raise JournalTruncated(
+                            f"Events before {self._first_seq} are no longer available"
+                        )
+                    spilled_until = self._first_seq
+                elif seq < self._next_seq:
+                    batch = list(
+                        itertools.islice(self._events, seq - self._first_seq, None)
+                    )
+                elif self.finished_at is not None:
+                    return
+                else:
+                    # Events may be evicted while waiting, so start over after it
+                    if not self._cond.wait(keepalive):
+                        batch = None
+                    else:
+                        continue
+
+            # Yield outside the lock so slow clients never block the producer
+            if spilled_until is not None:
+                batch = self._read_spilled(seq, spilled_until)
+            if batch is None:
+                yield None
+                continue
+            for event in batch:
+                yield seq, event
+                seq += 1
+
+    def remove_spill(self) -> None:
+        if self._spill_path and os.path.exists(self._spill_path):
+            os.remove(self._spill_path)
+
+
+class JournalStore:
+    """
+    Journals of recent streaming completions, kept for `ttl` seconds after
+    each completion finishes. At most `max_journals` are kept; beyond that,
+    the journals of the completions that finished first are dropped early.
+    Journals of running completions are never dropped.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        max_events: int = 4096,
+        spill_dir: Optional[str] = None,
+        max_journals: int = 1000,
+    ):
+        self.ttl = ttl
+        self.max_events = max_events
+        self.spill_dir = spill_dir
+        self.max_journals = max_journals
+        self._journals: dict[str, CompletionJournal] = {}
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def create(self, tenant: Optional[str]) -> CompletionJournal:
+        self.expire()
+        if self.max_journals:
+            self._evict_finished(self.max_journals - 1)
+        completion_id = uuid.uuid4().hex
+        spill_path = (
+            os.path.join(self.spill_dir, f"{completion_id}.jsonl")
+            if self.spill_dir
+            else None
+        )
+        journal = CompletionJournal(completion_id, tenant, self.max_events, spill_path)
+        with self._lock:
+            self._journals[completion_id] = journal
+        return journal
+
+    def get(self, completion_id: str) -> Optional[CompletionJournal]:
+        self.expire()
+        return self._journals.get(completion_id)
+
+    def expire(self) -> None:
+        """Drop journals of completions that finished more than `ttl` ago."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                journal
+                for journal in self._journals.values()
+                if journal.finished_at is not None and journal.finished_at < cutoff
+            ]
+            for journal in expired:
+                del self._journals[journal.id]
+        self._remove_spills(expired)
+
+    def _evict_finished(self, keep: int) -> None:
+        """Drop the oldest finished journals until at most `keep` remain."""
+        with self._lock:
+            excess = len(self._journals) - keep
+            if excess <= 0:
+                return
+            finished = sorted(
+                (j for j in self._journals.values() if j.finished_at is not None),
+                key=lambda j: j.finished_at,
+            )
+            evicted = finished[:excess]
+            for journal in evicted:
+                del self._journals[journal.id]
+        if len(evicted) < excess:
+            _logger.warning(
+                f"{len(self._journals)} journals held, more than the limit of "
+                f"{self.max_journals}, because their completions are still running"
+            )
+        self._remove_spills(evicted)
+
+    def _remove_spills(self, journals: list[CompletionJournal]) -> None:
+        for journal in journals:
+            try:
+                journal.remove_spill()
+            except OSError as e:
+                _logger.error(f"Failed to remove spill file of journal {journal.id}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._journals)
+
+
+def create_journal_store_from_env() -> JournalStore:
+    """Build the journal store from environment variables."""
+    return JournalStore(
+        ttl=float(os.environ.get("KAGI_JOURNAL_TTL", 300)),
+        max_events=int(os.environ.get("KAGI_JOURNAL_MAX_EVENTS", 4096)),
+        spill_dir=os.environ.get("KAGI_JOURNAL_SPILL_DIR") or None,
+        max_journals=int(os.environ.get("KAGI_JOURNAL_MAX_JOURNALS", 1000)),
+    )
@@ -0,0 +1,263 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Optional, TextIO
+
+_access_logger = logging.getLogger("ACCESS")
+
+# How much of a prompt may end up in the logs: "none", "truncated" or "full"
+LOG_PROMPTS = os.environ.get("KAGI_LOG_PROMPTS", "none").lower()
+LOG_PROMPT_MAX_CHARS = int(os.environ.get("KAGI_LOG_PROMPT_MAX_CHARS", 200))
+# Fraction of successful requests that get an access log entry, errors are always logged
+LOG_SAMPLE_RATE = float(os.environ.get("KAGI_LOG_SAMPLE_RATE", 1.0))
+# Records buffered for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("KAGI_LOG_QUEUE_SIZE", 10000))
+
+# Secrets that are masked before a prompt is logged
+REDACT_PATTERNS = [
+    re.compile(r"(?i)(bearer\s+)[A-Za-z0-9._~+/=-]+"),
+    re.compile(r"(?i)(kagi_session=)[^;\s]+"),
+    re.compile(r"()\bsk-[A-Za-z0-9_-]{8,}"),
+]
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional["DroppingQueueHandler"] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the writer thread without formatting them, so JSON
+    encoding and traceback formatting happen off the request thread. Records
+    are dropped and counted when the queue is full, e.g. while stdout is
+    blocked.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, they may be mutated after this call returns
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Wait for room, the sentinel must not be dropped from a full queue
+        self.queue.put(self._sentinel)
+
+
+def dropped_records() -> int:
+    """Number of log records dropped because the queue was full."""
+    return _handler.dropped if _handler is not None else 0
+
+
+def configure_logging(stream: Optional[TextIO] = None) -> None:
+    """
+    Route all logging through a queue so request threads never block on I/O.
+
+    Records are put on an in-memory queue of KAGI_LOG_QUEUE_SIZE records by
+    a handler on the root logger and formatted and written as JSON lines to
+    `stream` (stdout by default) by a background QueueListener thread.
+    Safe to call more than once.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(os.environ.get("KAGI_LOG_LEVEL", "INFO").upper())
+
+    _listener = _QueueListener(log_queue, stream_handler)
+    _listener.start()
+    # Flush whatever is still queued on shutdown
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Write out any queued records and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def redact(text: str) -> str:
+    """Mask anything that looks like a credential."""
+    for pattern in REDACT_PATTERNS:
+        text = pattern.sub(r"\1[REDACTED]", text)
+    return text
+
+
+def summarize_prompt(prompt: str) -> dict[str, Any]:
+    """
+    Describe a prompt for logging according to KAGI_LOG_PROMPTS. Only the
+    length is included by default; the text itself is truncated to
+    KAGI_LOG_PROMPT_MAX_CHARS unless full logging is enabled, and is always
+    redacted.
+    """
+    summary: dict[str, Any] = {"prompt_chars": len(prompt)}
+    if LOG_PROMPTS == "truncated":
+        # Truncate before redacting so multi-MB prompts are never scanned
+        summary["prompt"] = redact(prompt[:LOG_PROMPT_MAX_CHARS])
+    elif LOG_PROMPTS == "full":
+        summary["prompt"] = redact(prompt)
+    return summary
+
+
+class AccessLog:
+    """
+    Collects the details of one proxied request and emits a single JSON
+    access log entry when it finishes.
+    """
+
+    def __init__(self, method: str, path: str, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.tenant: Optional[str] = None
+        self.model: Optional[str] = None
+        self.upstream_model: Optional[str] = None
+        self.stream: Optional[bool] = None
+        self.status: Optional[int] = None
+        self.error: Optional[str] = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.output_chars = 0
+        self.started_at = time.monotonic()
+        self.first_output_at: Optional[float] = None
+        self._finished = False
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def defer(self) -> None:
+        """
+        Require one more finish() call before the entry is emitted, for work
+        such as a background completion that can outlive the response.
+        """
+        with self._lock:
+            self._pending += 1
+
+    def record_output(self, content: str) -> None:
+        """Record a chunk of generated content sent to the client."""
+        if self.first_output_at is None:
+            self.first_output_at = time.monotonic()
+        self.output_chars += len(content)
+
+    def count_bytes(self, body):
+        """Wrap a streamed response body, adding its size to bytes_out."""
+        try:
+            for part in body:
+                self.bytes_out += len(part)
+                yield part
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def finish(self) -> None:
+        """
+        Emit the access log entry once finish() has been called once, plus
+        once per defer(). Further calls have no effect.
+        """
+        with self._lock:
+            if self._finished:
+                return
+            self._pending -= 1
+            if self._pending > 0:
+                return
+            self._finished = True
+
+        failed = self.error is not None or (self.status or 0) >= 400
+        if not failed and random.random() >= LOG_SAMPLE_RATE:
+            return
+
+        duration = time.monotonic() - self.started_at
+        ttft = (
+            self.first_output_at - self.started_at
+            if self.first_output_at is not None
+            else None
+        )
+        fields = {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "tenant": self.tenant,
+            "model": self.model,
+            "upstream_model": self.upstream_model,
+            "stream": self.stream,
+            "status": self.status,
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "duration_ms": round(duration * 1000, 1),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "output_chars": self.output_chars,
+        }
+        if self.error is not None:
+            fields["error"] = self.error
+        _access_logger.log(
+            logging.WARNING if failed else logging.INFO,
+            "request",
+            extra={"fields": fields},
+        )
@@ -16,20 +16,63 @@
 
 import json
 import logging
+import os
+import time
 
 import requests
+from urllib3.exceptions import ReadTimeoutError
 
 from lib.auth import KagiSessionManager
 from lib.headers import DEFAULT_HEADERS
+from lib.logs import summarize_prompt
 from lib.query.parse import parse_kagi_sse_stream
+from lib.routing import get_latency_router
+from lib.state import get_state_backend
 
 _logger = logging.getLogger("SERVER").getChild("STREAM")
 
 _kagi_session_manager = KagiSessionManager()
+_state = get_state_backend()
+_router = get_latency_router()
 
+# Seconds to connect to Kagi, and the longest silence allowed while reading a reply
+CONNECT_TIMEOUT = float(os.environ.get("KAGI_CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.environ.get("KAGI_READ_TIMEOUT", 120))
 
-def stream_query(prompt: str, model: str):
-    print(prompt)
+
+# Prefix of token lines, which the non-streaming path buffers without parsing
+TOKENS_PREFIX = b"tokens.json:"
+
+
+# Error for an expired or invalid session key, which fails the same way for every model
+INVALID_SESSION_ERROR = "Error: invalid session key"
+
+
+class KagiError(Exception):
+    """A failed Kagi request, with the HTTP status the proxy should respond with."""
+
+    def __init__(self, message, status_code=502, code="upstream_error", details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.details = details
+
+
+def _is_timeout(e: Exception) -> bool:
+    # requests wraps a read timeout while iterating a stream in a ConnectionError
+    if isinstance(e, requests.Timeout):
+        return True
+    return isinstance(e, requests.ConnectionError) and any(
+        isinstance(arg, ReadTimeoutError) for arg in e.args
+    )
+
+
+def _send_prompt(prompt: str, model: str):
+    """POST the prompt to Kagi. Returns the streaming response and the cookies used."""
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug(
+            "Sending prompt", extra={"fields": {"model": model, **summarize_prompt(prompt)}}
+        )
 
     headers = DEFAULT_HEADERS.copy()
     headers["accept"] = "application/vnd.kagi.stream"
@@ -53,43 +96,86 @@ def stream_query(prompt: str, model: str):
         "kagi_session": _kagi_session_manager.get_session_key(),
     }
 
-    thread_id = None
+    response = requests.post(
+        "https://kagi.com/assistant/prompt",
+        cookies=cookies,
+        headers=headers,
+        json=data,
+        stream=True,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+    )
+
+    if response.status_code == 200:
+        _rotate_session_key(response, cookies)
+    return response, cookies
+
+
+def _rotate_session_key(response, cookies):
+    # The session key appears to rotate so we need to update it on each request.
+    # The manager writes it to the shared state so every worker sees the new key.
+    set_cookie_header = response.headers.get("set-cookie")
+    if set_cookie_header and "kagi_session" in set_cookie_header:
+        p1 = set_cookie_header.split("kagi_session=")
+        if len(p1) == 2:
+            p2 = p1[1].split(";")
+            if len(p2) > 2:
+                new_session_key = p2[0]
+                if new_session_key != cookies["kagi_session"]:
+                    _kagi_session_manager.set_session_key(new_session_key)
+                    _state.incr("session_key.rotations")
+
+
+def _delete_thread(thread_id, cookies):
     try:
-        response = requests.post(
-            "https://kagi.com/assistant/prompt",
+        requests.post(
+            "https://kagi.com/assistant/thread_delete",
+            headers=DEFAULT_HEADERS,
             cookies=cookies,
-            headers=headers,
-            json=data,
-            stream=True,
+            json={"focus": {"thread_id": thread_id}},
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
         )
+    except Exception as e:
+        # Log the error but don't fail the request
+        _logger.error(f"Failed to delete thread {thread_id}: {e}")
+
+
+def stream_query(prompt: str, model: str):
+    thread_id = None
+    # Latency statistics used to route virtual models
+    started_at = time.monotonic()
+    first_token_at = None
+    token_count = 0
+    try:
+        response, cookies = _send_prompt(prompt, model)
 
         if response.status_code == 404:
-            yield f"data: {json.dumps({'error': f'Error: invalid session key', 'details': None})}\n\n"
+            yield f"data: {json.dumps({'error': INVALID_SESSION_ERROR, 'details': None})}\n\n"
             return
         elif response.status_code != 200:
+            _router.record_error(model)
             yield f"data: {json.dumps({'error': f'Error: {response.status_code}', 'details': response.text})}\n\n"
             return
 
-        # The session key appears to rotate so we need to update it on each request
-        set_cookie_header = response.headers.get("set-cookie")
-        if set_cookie_header and "kagi_session" in set_cookie_header:
-            p1 = set_cookie_header.split("kagi_session=")
-            if len(p1) == 2:
-                p2 = p1[1].split(";")
-                if len(p2) > 2:
-                    new_session_key = p2[0]
-                    _kagi_session_manager.set_session_key(new_session_key)
-
         for line in response.iter_lines():
             message = parse_kagi_sse_stream(line)
             if not message:
                 continue
 
             if message["type"] == "new_message_json" and message["state"] == "done":
+                if first_token_at is not None:
+                    _router.record_success(
+                        model,
+                        first_token_at - started_at,
+                        token_count,
+                        time.monotonic() - first_token_at,
+                    )
                 # Send the final message
                 yield f"data: {json.dumps({'type': 'final', 'content': message['reply']})}\n\n"
 
             if message["type"] == "tokens_json":
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                token_count += 1
                 # Stream the tokens as they come
                 yield f"data: {json.dumps({'type': 'token', 'content': message['text']})}\n\n"
             elif message["type"] == "thread_json":
@@ -98,18 +184,113 @@ def stream_query(prompt: str, model: str):
 
         # Delete the thread
         if thread_id:
-            try:
-                requests.post(
-                    "https://kagi.com/assistant/thread_delete",
-                    headers=DEFAULT_HEADERS,
-                    cookies=cookies,
-                    json={"focus": {"thread_id": thread_id}},
-                )
-            except Exception as e:
-                # Log the error but don't fail the request
-                _logger.error(f"Failed to delete thread {thread_id}: {e}")
+            _delete_thread(thread_id, cookies)
 
             # Send a completion signal
             yield f"data: {json.dumps({'type': 'done'})}\n\n"
     except Exception as e:
+        _router.record_error(model)
         yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
+def complete_query(prompt: str, model: str):
+    """
+    Run a prompt to completion for a non-streaming response.
+
+    Token lines are buffered as raw bytes and only decoded if the stream ends
+    without a final reply. Returns as soon as Kagi reports the message as
+    done; closing the stream and deleting the thread is left to the returned
+    cleanup callable, which the caller should run after responding.
+
+    Returns:
+        tuple[str, Callable[[], None]]: The reply and the cleanup callable.
+
+    Raises:
+        KagiError: If Kagi fails or returns no reply.
+    """
+    started_at = time.monotonic()
+    try:
+        response, cookies = _send_prompt(prompt, model)
+    except requests.RequestException as e:
+        _router.record_error(model)
+        if _is_timeout(e):
+            raise KagiError(f"Kagi timed out: {e}", 504, "upstream_timeout")
+        raise KagiError(f"Kagi is unavailable: {e}", 502, "upstream_unavailable")
+
+    if response.status_code == 404:
+        response.close()
+        raise KagiError(INVALID_SESSION_ERROR, 502, "invalid_session_key")
+    elif response.status_code != 200:
+        response.close()
+        _router.record_error(model)
+        if response.status_code == 429:
+            raise KagiError(
+                "Error: 429", 429, "rate_limit_exceeded", details=response.text
+            )
+        raise KagiError(
+            f"Error: {response.status_code}", 502, "upstream_error", details=response.text
+        )
+
+    thread_id = None
+    reply = None
+    token_lines = []
+    first_token_at = None
+    lines = response.iter_lines()
+
+    def cleanup():
+        nonlocal thread_id
+        try:
+            # The thread ID normally arrives before the reply, otherwise read on
+            if thread_id is None:
+                for line in lines:
+                    message = parse_kagi_sse_stream(line)
+                    if message and message["type"] == "thread_json":
+                        thread_id = message["data"]["id"]
+                        break
+        except Exception as e:
+            _logger.error(f"Failed to read Kagi stream after the reply: {e}")
+        finally:
+            response.close()
+        if thread_id:
+            _delete_thread(thread_id, cookies)
+
+    try:
+        for line in lines:
+            if line.startswith(TOKENS_PREFIX):
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                token_lines.append(line)
+                continue
+
+            message = parse_kagi_sse_stream(line)
+            if not message:
+                continue
+
+            if message["type"] == "thread_json":
+                thread_id = message["data"]["id"]
+            elif message["type"] == "new_message_json" and message["state"] == "done":
+                if first_token_at is not None:
+                    _router.record_success(
+                        model,
+                        first_token_at - started_at,
+                        len(token_lines),
+                        time.monotonic() - first_token_at,
+                    )
+                reply = message["reply"]
+                break
+
+        # The stream ended without a final reply, fall back to the tokens
+        if reply is None and token_lines:
+            reply = "".join(parse_kagi_sse_stream(line)["text"] for line in token_lines)
+    except Exception as e:
+        cleanup()
+        _router.record_error(model)
+        if _is_timeout(e):
+            raise KagiError(f"Kagi timed out: {e}", 504, "upstream_timeout")
+        raise KagiError(str(e))
+
+    if reply is None:
+        cleanup()
+        _router.record_error(model)
+        raise KagiError("Kagi returned no reply", 502, "empty_reply")
+    return reply, cleanup
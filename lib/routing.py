@@ -0,0 +1,258 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Optional
+
+_logger = logging.getLogger("ROUTING")
+
+# Built-in virtual model that routes to the fastest of all available models
+AUTO_FASTEST = "auto/fastest"
+# Separator for an ad-hoc list of acceptable models in the `model` field
+MODEL_LIST_SEPARATOR = ","
+
+# Consecutive errors after which a model is taken out of rotation
+ERROR_THRESHOLD = 3
+ERROR_COOLDOWN = 15  # seconds, doubled for every further error
+MAX_ERROR_COOLDOWN = 300
+
+
+class DecayedAverage:
+    """
+    Average in which each sample's weight halves every `half_life` seconds,
+    so recent behaviour dominates without discarding history abruptly.
+    """
+
+    def __init__(self, half_life: float):
+        self.half_life = half_life
+        self._total = 0.0
+        self._weight = 0.0
+        self._updated = 0.0
+
+    def _decay(self, now: float) -> float:
+        if not self._weight:
+            return 1.0
+        return 0.5 ** ((now - self._updated) / self.half_life)
+
+    def add(self, value: float, now: float) -> None:
+        decay = self._decay(now)
+        self._total = self._total * decay + value
+        self._weight = self._weight * decay + 1
+        self._updated = now
+
+    def value(self) -> Optional[float]:
+        return self._total / self._weight if self._weight else None
+
+    def weight(self, now: float) -> float:
+        """Effective number of recent samples."""
+        return self._weight * self._decay(now)
+
+
+class ModelStats:
+    """Live latency and error statistics for one Kagi model."""
+
+    def __init__(self, half_life: float):
+        self.ttft = DecayedAverage(half_life)
+        self.tokens_per_sec = DecayedAverage(half_life)
+        self.error_rate = DecayedAverage(half_life)
+        self.consecutive_errors = 0
+        self.unavailable_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.unavailable_until
+
+    def score(self, reference_tokens: int) -> Optional[float]:
+        """
+        Expected seconds to deliver a reply of `reference_tokens` tokens,
+        inflated by the recent error rate. Lower is better, None if the model
+        has not produced a reply yet.
+        """
+        ttft = self.ttft.value()
+        if ttft is None:
+            return None
+        expected = ttft
+        tokens_per_sec = self.tokens_per_sec.value()
+        if tokens_per_sec:
+            expected += reference_tokens / tokens_per_sec
+        return expected / max(0.05, 1 - (self.error_rate.value() or 0))
+
+    def to_dict(self, now: float, reference_tokens: int) -> dict[str, Any]:
+        ttft = self.ttft.value()
+        tokens_per_sec = self.tokens_per_sec.value()
+        error_rate = self.error_rate.value()
+        score = self.score(reference_tokens)
+        return {
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "tokens_per_sec": (
+                round(tokens_per_sec, 1) if tokens_per_sec is not None else None
+            ),
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            "samples": round(self.ttft.weight(now), 2),
+            "score": round(score, 3) if score is not None else None,
+            "available": self.available(now),
+        }
+
+
+class LatencyRouter:
+    """
+    Routes virtual model IDs to the Kagi model expected to answer fastest.
+
+    Every completion made through `stream_query` reports its time to first
+    token and tokens/sec. Requests for a virtual model are sent to the
+    candidate with the best decayed score, except for a small fraction
+    (`explore_rate`) sent to a random candidate so that the statistics of
+    the other models stay current. Models that keep erroring are skipped
+    for a growing cooldown, and the remaining candidates are returned in
+    score order so the caller can fall back to them.
+    """
+
+    def __init__(
+        self,
+        virtual_models: Optional[dict[str, list[str]]] = None,
+        half_life: float = 300,
+        explore_rate: float = 0.05,
+        reference_tokens: int = 200,
+    ):
+        self.virtual_models = virtual_models or {}
+        self.half_life = half_life
+        self.explore_rate = explore_rate
+        self.reference_tokens = reference_tokens
+        self._stats: dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def _get_stats(self, kagi_model: str) -> ModelStats:
+        stats = self._stats.get(kagi_model)
+        if stats is None:
+            stats = self._stats.setdefault(kagi_model, ModelStats(self.half_life))
+        return stats
+
+    def virtual_model_ids(self) -> list[str]:
+        return sorted({AUTO_FASTEST, *self.virtual_models})
+
+    def candidates(
+        self, requested_model: str, mapping: dict[str, str]
+    ) -> Optional[list[str]]:
+        """
+        Return the Kagi models a virtual model ID may be routed to, or None if
+        `requested_model` is an ordinary model ID or not a string.
+        """
+        if not isinstance(requested_model, str):
+            return None
+        if requested_model in self.virtual_models:
+            model_ids = self.virtual_models[requested_model]
+        elif requested_model == AUTO_FASTEST:
+            model_ids = list(mapping)
+        elif MODEL_LIST_SEPARATOR in requested_model:
+            model_ids = [m.strip() for m in requested_model.split(MODEL_LIST_SEPARATOR)]
+        else:
+            return None
+        return [mapping[m] for m in model_ids if m in mapping]
+
+    def rank(self, kagi_models: list[str]) -> list[str]:
+        """Order candidate Kagi models, the one to use first at the front."""
+        now = time.time()
+        with self._lock:
+            healthy = [m for m in kagi_models if self._get_stats(m).available(now)]
+            # If everything is failing, still try rather than refuse the request
+            candidates = healthy or list(kagi_models)
+            scores = {m: self._get_stats(m).score(self.reference_tokens) for m in candidates}
+
+        # Measured models by score, then unmeasured ones in configured order
+        ranked = sorted(
+            candidates,
+            key=lambda m: (scores[m] is None, scores[m] or 0),
+        )
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            explored = random.choice(ranked[1:])
+            ranked.remove(explored)
+            ranked.insert(0, explored)
+        return ranked
+
+    def record_success(
+        self, kagi_model: str, ttft: float, tokens: int, duration: float
+    ) -> None:
+        """Record a completed reply: time to first token and streaming time."""
+        now = time.time()
+        with self._lock:
+            stats = self._get_stats(kagi_model)
+            stats.ttft.add(ttft, now)
+            if tokens > 1 and duration > 0:
+                stats.tokens_per_sec.add(tokens / duration, now)
+            stats.error_rate.add(0, now)
+            stats.consecutive_errors = 0
+            stats.unavailable_until = 0.0
+
+    def record_error(self, kagi_model: str) -> None:
+        now = time.time()
+        with self._lock:
+            stats = self._get_stats(kagi_model)
+            stats.error_rate.add(1, now)
+            stats.consecutive_errors += 1
+            if stats.consecutive_errors >= ERROR_THRESHOLD:
+                cooldown = min(
+                    MAX_ERROR_COOLDOWN,
+                    ERROR_COOLDOWN * 2 ** (stats.consecutive_errors - ERROR_THRESHOLD),
+                )
+                stats.unavailable_until = now + cooldown
+                _logger.warning(
+                    f"Model {kagi_model} failed {stats.consecutive_errors} times in a row, "
+                    f"skipping it for {cooldown}s"
+                )
+
+    def stats(self) -> dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            return {
+                model: stats.to_dict(now, self.reference_tokens)
+                for model, stats in sorted(self._stats.items())
+            }
+
+
+_router: Optional[LatencyRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_latency_router() -> LatencyRouter:
+    """
+    Return the process-wide router, creating it on first use.
+
+    Virtual models are read from the JSON file named by
+    KAGI_VIRTUAL_MODELS_FILE, mapping each virtual ID to a list of
+    OpenAI-compatible model IDs:
+
+        {"auto/fast-chat": ["openai/gpt-5-mini", "google/gemini-2.5-flash"]}
+    """
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                virtual_models = {}
+                path = os.environ.get("KAGI_VIRTUAL_MODELS_FILE")
+                if path:
+                    with open(path) as f:
+                        virtual_models = json.load(f)
+                    _logger.info(f"Loaded {len(virtual_models)} virtual models from {path}")
+                _router = LatencyRouter(
+                    virtual_models,
+                    half_life=float(os.environ.get("KAGI_ROUTING_HALF_LIFE", 300)),
+                    explore_rate=float(os.environ.get("KAGI_ROUTING_EXPLORE_RATE", 0.05)),
+                )
+    return _router
@@ -0,0 +1,414 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Optional
+
+_logger = logging.getLogger("SCHEDULER")
+
+# Priority classes, lower values are dispatched first
+PRIORITY_INTERACTIVE = 0  # streaming requests
+PRIORITY_BULK = 1  # non-streaming requests
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BULK: "bulk",
+}
+
+# Tenant used for every request when no tenants are configured
+DEFAULT_TENANT_NAME = "default"
+
+# Number of recent requests per tenant used for latency percentiles
+LATENCY_WINDOW = 1000
+
+
+class SchedulerError(Exception):
+    """Base class for requests the scheduler refuses to run."""
+
+
+class RateLimited(SchedulerError):
+    """The tenant's token bucket is empty."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(SchedulerError):
+    """No execution slot became available before the queue timeout."""
+
+
+class TokenBucket:
+    """
+    Classic token bucket. `rate` tokens are added per second up to `burst`.
+    A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self) -> float:
+        """
+        Take one token. Returns 0 on success, otherwise the number of seconds
+        until a token will be available.
+        """
+        if not self.rate:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class TenantMetrics:
+    """Usage and latency counters for a single tenant."""
+
+    def __init__(self):
+        self.requests = 0
+        self.completed = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.queue_timeouts = 0
+        self.output_chars = 0
+        self.output_chunks = 0
+        self.queue_wait = deque(maxlen=LATENCY_WINDOW)
+        self.ttft = deque(maxlen=LATENCY_WINDOW)
+        self.duration = deque(maxlen=LATENCY_WINDOW)
+
+    @staticmethod
+    def _summary(samples) -> dict[str, Optional[float]]:
+        if not samples:
+            return {"p50_ms": None, "p95_ms": None, "max_ms": None}
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return {
+            "p50_ms": round(ordered[last // 2] * 1000, 1),
+            "p95_ms": round(ordered[int(last * 0.95)] * 1000, 1),
+            "max_ms": round(ordered[last] * 1000, 1),
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "completed": self.completed,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "queue_timeouts": self.queue_timeouts,
+            "output_chars": self.output_chars,
+            "output_chunks": self.output_chunks,
+            "queue_wait": self._summary(self.queue_wait),
+            "ttft": self._summary(self.ttft),
+            "duration": self._summary(self.duration),
+        }
+
+
+class Tenant:
+    """
+    An API client. `weight` is its share of the execution slots relative to
+    the other tenants, `max_concurrency` caps how many of its requests may
+    run at once (0 means no cap).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        weight: float = 1,
+        max_concurrency: int = 0,
+        rate: float = 0,
+        burst: float = 1,
+    ):
+        if weight <= 0:
+            raise ValueError(f"Tenant '{name}' weight must be positive")
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.metrics = TenantMetrics()
+        self.active = 0
+        # Start-time fair queueing tag of the tenant's most recent request
+        self.last_finish_tag = 0.0
+
+    def __repr__(self) -> str:
+        return f"Tenant(name={self.name!r}, weight={self.weight})"
+
+
+class Ticket:
+    """
+    A request's claim on an execution slot. Returned by
+    `FairScheduler.acquire()` and used to report progress and release the
+    slot. `release()` may safely be called more than once.
+    """
+
+    def __init__(self, scheduler: "FairScheduler", tenant: Tenant, priority: int):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.priority = priority
+        self.start_tag = 0.0
+        self.granted = False
+        self.released = False
+        self.error = False
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.first_output_at: Optional[float] = None
+        # Added to the tenant's metrics under the scheduler lock on release
+        self.output_chunks = 0
+        self.output_chars = 0
+
+    def record_output(self, content: str) -> None:
+        """Record a chunk of generated content sent to the client."""
+        if self.first_output_at is None:
+            self.first_output_at = time.monotonic()
+        self.output_chunks += 1
+        self.output_chars += len(content)
+
+    def release(self) -> None:
+        self.scheduler.release(self)
+
+
+class FairScheduler:
+    """
+    Weighted fair scheduler for upstream Kagi requests.
+
+    At most `max_concurrency` requests run at once (0 means unlimited). When
+    all slots are busy, waiting requests are dispatched strictly by priority
+    class and, within a class, by start-time fair queueing: every request is
+    tagged with its tenant's virtual finish time, which advances by
+    1/weight per request, so tenants receive slots in proportion to their
+    weight no matter how many requests they queue.
+    """
+
+    def __init__(self, max_concurrency: int = 0, queue_timeout: float = 60):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting: list[Ticket] = []
+        self._virtual_time = 0.0
+
+    def _has_capacity(self, tenant: Tenant) -> bool:
+        if self.max_concurrency and self._active >= self.max_concurrency:
+            return False
+        if tenant.max_concurrency and tenant.active >= tenant.max_concurrency:
+            return False
+        return True
+
+    def _grant(self, ticket: Ticket) -> None:
+        ticket.granted = True
+        ticket.started_at = time.monotonic()
+        ticket.tenant.active += 1
+        self._active += 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        ticket.tenant.metrics.queue_wait.append(ticket.started_at - ticket.enqueued_at)
+
+    def _dispatch(self) -> None:
+        """Grant slots to waiting tickets. Must be called with the lock held."""
+        granted = False
+        while self._waiting:
+            eligible = [t for t in self._waiting if self._has_capacity(t.tenant)]
+            if not eligible:
+                break
+            ticket = min(eligible, key=lambda t: (t.priority, t.start_tag))
+            self._waiting.remove(ticket)
+            self._grant(ticket)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def acquire(self, tenant: Tenant, priority: int = PRIORITY_BULK) -> Ticket:
+        """
+        Block until the tenant may run a request and return its ticket.
+
+        Raises:
+            RateLimited: If the tenant's rate limit is exhausted.
+            QueueTimeout: If no slot became free within the queue timeout.
+        """
+        retry_after = tenant.bucket.try_take()
+        ticket = Ticket(self, tenant, priority)
+        with self._cond:
+            tenant.metrics.requests += 1
+            if retry_after:
+                tenant.metrics.rate_limited += 1
+                raise RateLimited(retry_after)
+
+            ticket.start_tag = max(self._virtual_time, tenant.last_finish_tag)
+            tenant.last_finish_tag = ticket.start_tag + 1 / tenant.weight
+
+            if not self._waiting and self._has_capacity(tenant):
+                self._grant(ticket)
+                return ticket
+
+            self._waiting.append(ticket)
+            self._dispatch()
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    tenant.metrics.queue_timeouts += 1
+                    raise QueueTimeout(
+                        f"No capacity available within {self.queue_timeout:.0f}s"
+                    )
+                self._cond.wait(remaining)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """Return the ticket's slot and record its metrics."""
+        with self._cond:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            ticket.tenant.active -= 1
+            self._active -= 1
+
+            now = time.monotonic()
+            metrics = ticket.tenant.metrics
+            metrics.duration.append(now - ticket.started_at)
+            metrics.output_chunks += ticket.output_chunks
+            metrics.output_chars += ticket.output_chars
+            if ticket.first_output_at is not None:
+                metrics.ttft.append(ticket.first_output_at - ticket.started_at)
+            if ticket.error:
+                metrics.errors += 1
+            else:
+                metrics.completed += 1
+
+            self._dispatch()
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            queued: dict[str, dict[str, int]] = {}
+            for ticket in self._waiting:
+                per_class = queued.setdefault(ticket.tenant.name, {})
+                name = PRIORITY_NAMES[ticket.priority]
+                per_class[name] = per_class.get(name, 0) + 1
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self._active,
+                "queued": len(self._waiting),
+                "queued_by_tenant": queued,
+            }
+
+
+class TenantRegistry:
+    """
+    Maps API keys to tenants.
+
+    Tenants are read from the JSON file named by KAGI_TENANTS_FILE:
+
+        {
+            "tenants": [
+                {
+                    "name": "chat-ui",
+                    "api_keys": ["sk-..."],
+                    "weight": 4,
+                    "max_concurrency": 8,
+                    "rate": 2,
+                    "burst": 10
+                }
+            ]
+        }
+
+    `rate` is in requests per second. Rate limits and concurrency are
+    enforced per worker process, not across workers. When no file is
+    configured every request belongs to a single unrestricted default tenant
+    and API keys are not checked.
+    """
+
+    def __init__(self, tenants: Optional[list[dict[str, Any]]] = None):
+        self._by_key: dict[str, Tenant] = {}
+        self.tenants: dict[str, Tenant] = {}
+        self.default: Optional[Tenant] = None
+
+        if not tenants:
+            self.default = Tenant(DEFAULT_TENANT_NAME)
+            self.tenants[DEFAULT_TENANT_NAME] = self.default
+            return
+
+        for config in tenants:
+            tenant = Tenant(
+                config["name"],
+                weight=config.get("weight", 1),
+                max_concurrency=config.get("max_concurrency", 0),
+                rate=config.get("rate", 0),
+                burst=config.get("burst", 1),
+            )
+            if tenant.name in self.tenants:
+                raise ValueError(f"Duplicate tenant '{tenant.name}'")
+            self.tenants[tenant.name] = tenant
+            for api_key in config.get("api_keys", []):
+                self._by_key[api_key] = tenant
+
+    @classmethod
+    def from_file(cls, path: Optional[str]) -> "TenantRegistry":
+        if not path:
+            return cls()
+        with open(path) as f:
+            config = json.load(f)
+        registry = cls(config.get("tenants", []))
+        _logger.info(f"Loaded {len(registry.tenants)} tenants from {path}")
+        return registry
+
+    @property
+    def requires_auth(self) -> bool:
+        return self.default is None
+
+    def identify(self, authorization: Optional[str]) -> Optional[Tenant]:
+        """
+        Return the tenant for an `Authorization: Bearer <key>` header value,
+        or None if the key is missing or unknown.
+        """
+        if self.default is not None:
+            return self.default
+        if not authorization or not authorization.startswith("Bearer "):
+            return None
+        return self._by_key.get(authorization[len("Bearer ") :].strip())
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            name: {
+                "weight": tenant.weight,
+                "max_concurrency": tenant.max_concurrency,
+                "active": tenant.active,
+                **tenant.metrics.to_dict(),
+            }
+            for name, tenant in self.tenants.items()
+        }
+
+
+def create_scheduler_from_env() -> tuple[TenantRegistry, FairScheduler]:
+    """Build the tenant registry and scheduler from environment variables."""
+    registry = TenantRegistry.from_file(os.environ.get("KAGI_TENANTS_FILE"))
+    scheduler = FairScheduler(
+        max_concurrency=int(os.environ.get("KAGI_MAX_CONCURRENCY", 0)),
+        queue_timeout=float(os.environ.get("KAGI_QUEUE_TIMEOUT", 60)),
+    )
+    return registry, scheduler
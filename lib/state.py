@@ -0,0 +1,318 @@
+# kagi-assistant-proxy - A proxy that exposes Kagi's LLM platform
+# Copyright (C) 2024-2025  Cyberes, Alex Lee
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Optional
+
+_logger = logging.getLogger("STATE")
+
+# Environment variables used to select the shared state backend
+STATE_BACKEND_ENV = "KAGI_STATE_BACKEND"
+STATE_PATH_ENV = "KAGI_STATE_PATH"
+DEFAULT_STATE_PATH = "kagi-proxy-state.sqlite3"
+
+
+class StateBackend(abc.ABC):
+    """
+    Key/value store for state that has to be shared by every worker process:
+    the rotating session key, the model mapping cache and a few counters.
+
+    Reads never take a Python lock so they stay cheap on the request path.
+    Writes are serialized by the backend.
+    """
+
+    def __init__(self):
+        # Per-process cache of decoded JSON values, keyed by store key.
+        # Each entry is (version, value) so it is only re-decoded after a write.
+        self._json_cache: dict[str, tuple[int, Any]] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the raw value stored under `key` or None."""
+        value, _ = self.get_versioned(key)
+        return value
+
+    @abc.abstractmethod
+    def get_versioned(self, key: str) -> tuple[Optional[str], int]:
+        """Return (value, version) for `key`. Version is 0 if the key is unset."""
+
+    def get_version(self, key: str) -> int:
+        """Return the current version of `key` without fetching its value."""
+        return self.get_versioned(key)[1]
+
+    @abc.abstractmethod
+    def set(self, key: str, value: str) -> None:
+        """Store `value` under `key` and bump its version."""
+
+    def get_json(self, key: str, default: Any = None) -> Any:
+        """
+        Return the decoded JSON value stored under `key`.
+
+        The decoded object is cached per process and reused until another
+        process (or thread) writes a new version, so repeated reads of a
+        large value such as the model mapping only cost a version lookup.
+        Callers must treat the returned object as read-only.
+        """
+        version = self.get_version(key)
+        if not version:
+            return default
+
+        cached = self._json_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        raw, version = self.get_versioned(key)
+        if raw is None:
+            return default
+        value = json.loads(raw)
+        self._json_cache[key] = (version, value)
+        return value
+
+    def set_json(self, key: str, value: Any) -> None:
+        """Encode `value` as JSON and store it under `key`."""
+        self.set(key, json.dumps(value))
+
+    @abc.abstractmethod
+    def incr(self, name: str, amount: int = 1) -> int:
+        """Atomically add `amount` to counter `name` and return the new value."""
+
+    @abc.abstractmethod
+    def counters(self) -> dict[str, int]:
+        """Return a snapshot of every counter."""
+
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """
+        Try to take the named lease for `ttl` seconds.
+
+        Used so that only one worker performs expensive refreshes (such as
+        scraping the model mapping) while the others keep serving the
+        cached copy. Returns True if this process now holds the lease.
+        """
+
+    @abc.abstractmethod
+    def release_lease(self, name: str) -> None:
+        """Release the named lease if this process holds it."""
+
+
+class LocalStateBackend(StateBackend):
+    """
+    In-process backend. This is the default and matches the behaviour of a
+    single-worker deployment. Values are not shared between processes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._values: dict[str, tuple[str, int]] = {}
+        self._counters: dict[str, int] = {}
+        self._leases: dict[str, float] = {}
+        self._write_lock = threading.Lock()
+
+    def get_versioned(self, key: str) -> tuple[Optional[str], int]:
+        # dict.get is atomic under the GIL, no lock needed for reads
+        return self._values.get(key, (None, 0))
+
+    def set(self, key: str, value: str) -> None:
+        with self._write_lock:
+            _, version = self._values.get(key, (None, 0))
+            self._values[key] = (value, version + 1)
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        with self._write_lock:
+            value = self._counters.get(name, 0) + amount
+            self._counters[name] = value
+            return value
+
+    def counters(self) -> dict[str, int]:
+        return dict(self._counters)
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._write_lock:
+            if self._leases.get(name, 0) > now:
+                return False
+            self._leases[name] = now + ttl
+            return True
+
+    def release_lease(self, name: str) -> None:
+        with self._write_lock:
+            self._leases.pop(name, None)
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Backend stored in a SQLite database in WAL mode so that every worker
+    process on the host sees the same state.
+
+    WAL lets readers run concurrently with a writer, so reads on the request
+    path never block. Each thread gets its own connection, and connections
+    and the lease owner ID are re-created after a fork so that pre-forking
+    servers (gunicorn with `--preload`) do not share them between processes.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._path = path
+        self._owner_pid: Optional[int] = None
+        self._owner_id = ""
+        self._local = threading.local()
+        self._create_schema()
+
+    @property
+    def _owner(self) -> str:
+        # Lease owner, unique per process so forked workers do not share it
+        if self._owner_pid != os.getpid():
+            self._owner_id = f"{os.getpid()}-{uuid.uuid4().hex}"
+            self._owner_pid = os.getpid()
+        return self._owner_id
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(
+            self._path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_schema(self) -> None:
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            "name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def get_versioned(self, key: str) -> tuple[Optional[str], int]:
+        row = (
+            self._connect()
+            .execute("SELECT value, version FROM kv WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None, 0
+        return row[0], row[1]
+
+    def get_version(self, key: str) -> int:
+        row = (
+            self._connect()
+            .execute("SELECT version FROM kv WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def set(self, key: str, value: str) -> None:
+        self._connect().execute(
+            "INSERT INTO kv (key, value, version) VALUES (?, ?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, version = version + 1",
+            (key, value),
+        )
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+            value = conn.execute(
+                "SELECT value FROM counters WHERE name = ?", (name,)
+            ).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def counters(self) -> dict[str, int]:
+        rows = self._connect().execute("SELECT name, value FROM counters").fetchall()
+        return dict(rows)
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT expires FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None and row[0] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, self._owner, now + ttl),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def release_lease(self, name: str) -> None:
+        self._connect().execute(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (name, self._owner)
+        )
+
+
+_backend: Optional[StateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """
+    Return the process-wide state backend, creating it on first use.
+
+    The backend is selected with the KAGI_STATE_BACKEND environment variable
+    ("local" or "sqlite"). The SQLite database location is taken from
+    KAGI_STATE_PATH.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                kind = os.environ.get(STATE_BACKEND_ENV, "local").lower()
+                if kind == "sqlite":
+                    path = os.environ.get(STATE_PATH_ENV, DEFAULT_STATE_PATH)
+                    _logger.info(f"Using SQLite state backend at {path}")
+                    _backend = SQLiteStateBackend(path)
+                elif kind == "local":
+                    _backend = LocalStateBackend()
+                else:
+                    raise ValueError(
+                        f"Unknown {STATE_BACKEND_ENV} '{kind}', expected 'local' or 'sqlite'"
+                    )
+    return _backend
@@ -14,31 +14,62 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hmac
 import json
+import logging
+import math
 import os
 import sys
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import (
     Flask,
     Response,
+    g,
     jsonify,
     request,
     send_from_directory,
-    stream_with_context,
 )
 
 from lib.auth import KagiSessionManager
+from lib.journal import JournalTruncated, create_journal_store_from_env
+from lib.logs import AccessLog, configure_logging, dropped_records
 from lib.mapping import DEFAULT_MODEL, MODEL_MAPPING, get_latest_model_mapping
-from lib.query.query import stream_query
+from lib.query.query import (
+    INVALID_SESSION_ERROR,
+    KagiError,
+    complete_query,
+    stream_query,
+)
+from lib.routing import get_latency_router
+from lib.scheduler import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    QueueTimeout,
+    RateLimited,
+    create_scheduler_from_env,
+)
+from lib.state import get_state_backend
 
-# Model mapping cache with 6-hour TTL
-_model_mapping_cache = {
-    "mapping": MODEL_MAPPING,
-    "timestamp": time.time() if MODEL_MAPPING else 0,
-}
+configure_logging()
+_logger = logging.getLogger("SERVER")
+
+# Model mapping cache with 6-hour TTL, kept in the shared state backend so
+# that all worker processes use (and refresh) a single copy.
+MODEL_MAPPING_CACHE_KEY = "model_mapping"
 MODEL_MAPPING_CACHE_TTL = 6 * 60 * 60  # 6 hours in seconds
+# Only one worker scrapes Kagi at a time, the rest keep serving the cached copy
+MODEL_MAPPING_REFRESH_LEASE = "model_mapping.refresh"
+MODEL_MAPPING_REFRESH_LEASE_TTL = 60
+
+state = get_state_backend()
+if MODEL_MAPPING and not state.get_json(MODEL_MAPPING_CACHE_KEY):
+    state.set_json(
+        MODEL_MAPPING_CACHE_KEY, {"mapping": MODEL_MAPPING, "timestamp": time.time()}
+    )
 
 app = Flask(__name__)
 
@@ -49,16 +80,91 @@ if not kagi_session_key:
     )
     sys.exit(1)
 kagi_session_manager = KagiSessionManager()
-kagi_session_manager.set_session_key(kagi_session_key)
+kagi_session_manager.seed_session_key(kagi_session_key)
+
+tenant_registry, scheduler = create_scheduler_from_env()
+router = get_latency_router()
+journals = create_journal_store_from_env()
+
+# Bearer key for /metrics. Required whenever tenants are configured
+METRICS_KEY = os.environ.get("KAGI_METRICS_KEY")
+
+# Seconds without events after which an SSE comment is sent to detect dropped clients
+STREAM_KEEPALIVE = 15
+
+# Upstream attempts per request when a virtual model's first choice fails
+MAX_UPSTREAM_ATTEMPTS = 3
+
+# Closes Kagi streams and deletes threads after non-streaming replies. Some
+# servers (hypercorn) only end the response after its close callbacks return,
+# so this must not run on the request thread.
+cleanup_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("KAGI_CLEANUP_THREADS", 8)),
+    thread_name_prefix="kagi-cleanup",
+)
+
+
+def get_model_mapping():
+    """Return the cached model mapping shared by all workers"""
+    cached = state.get_json(MODEL_MAPPING_CACHE_KEY)
+    if cached and cached["mapping"]:
+        return cached["mapping"]
+    return MODEL_MAPPING
+
+
+def refresh_model_mapping():
+    """Scrape the model mapping from Kagi and store it for all workers"""
+    try:
+        mapping = get_latest_model_mapping()
+    except Exception:
+        state.incr("model_mapping.refresh_failures")
+        raise
+    state.set_json(MODEL_MAPPING_CACHE_KEY, {"mapping": mapping, "timestamp": time.time()})
+    state.incr("model_mapping.refreshes")
+    return mapping
 
 
-def create_chat_completion_chunk(content, finish_reason=None):
+class ModelNotFound(Exception):
+    """A virtual model ID that matches no available Kagi model."""
+
+
+def resolve_kagi_models(requested_model):
+    """
+    Map an OpenAI-compatible model ID to the Kagi models to query, in order.
+    Virtual model IDs are routed to the currently fastest candidate, with
+    the others as fallbacks.
+
+    Raises ModelNotFound if a virtual model ID has no available candidates.
+    """
+    mapping = get_model_mapping()
+    candidates = router.candidates(requested_model, mapping)
+    if candidates is None:
+        return [mapping.get(requested_model, DEFAULT_MODEL)]
+
+    # The mapping is empty until it has been scraped with a valid session key
+    if not candidates and not mapping and state.acquire_lease(
+        MODEL_MAPPING_REFRESH_LEASE, MODEL_MAPPING_REFRESH_LEASE_TTL
+    ):
+        try:
+            mapping = refresh_model_mapping()
+        except Exception as e:
+            _logger.warning(f"Failed to fetch models from Kagi: {e}")
+        finally:
+            state.release_lease(MODEL_MAPPING_REFRESH_LEASE)
+        candidates = router.candidates(requested_model, mapping)
+
+    if not candidates:
+        raise ModelNotFound(f"The model '{requested_model}' does not match any available model")
+    return router.rank(candidates)
+
+
+def create_chat_completion_chunk(content, model, finish_reason=None):
     """Create a chat completion chunk in OpenAI format"""
     chunk = {
         "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
         "object": "chat.completion.chunk",
         "created": int(time.time()),
-        "model": request.json.get("model", MODEL_MAPPING.get(DEFAULT_MODEL)),
+        "model": model,
         "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
     }
 
@@ -108,9 +214,292 @@ def convert_messages_to_prompt(messages):
     return "\n\n".join(prompt_parts)
 
 
+def stream_with_fallback(prompt, kagi_models, access_log):
+    """
+    Run stream_query against the first Kagi model, falling back to the next
+    candidate if it fails before producing any output. An invalid session key
+    fails for every model, so it is not retried.
+    """
+    attempts = kagi_models[:MAX_UPSTREAM_ATTEMPTS]
+    for attempt, kagi_model in enumerate(attempts):
+        access_log.upstream_model = kagi_model
+        upstream = stream_query(prompt, kagi_model)
+        has_output = False
+        for chunk in upstream:
+            if not has_output and attempt + 1 < len(attempts):
+                error = json.loads(chunk[6:]).get("error")
+                if error and error != INVALID_SESSION_ERROR:
+                    _logger.warning(
+                        "Upstream model failed, falling back",
+                        extra={"fields": {"model": kagi_model, "error": error}},
+                    )
+                    upstream.close()
+                    break
+            has_output = True
+            yield chunk
+        else:
+            return
+
+
+def complete_with_fallback(prompt, kagi_models, access_log):
+    """
+    Run complete_query against the first Kagi model, falling back to the next
+    candidate if it fails. An invalid session key fails for every model, so it
+    is not retried. Returns the reply and its cleanup callable.
+    """
+    attempts = kagi_models[:MAX_UPSTREAM_ATTEMPTS]
+    for attempt, kagi_model in enumerate(attempts):
+        access_log.upstream_model = kagi_model
+        try:
+            return complete_query(prompt, kagi_model)
+        except KagiError as e:
+            if attempt + 1 == len(attempts) or e.code == "invalid_session_key":
+                raise
+            _logger.warning(
+                "Upstream model failed, falling back",
+                extra={"fields": {"model": kagi_model, "error": str(e)}},
+            )
+
+
+def generate_chat_completion_chunks(prompt, kagi_models, model, ticket, access_log):
+    """
+    Stream a completion from Kagi as OpenAI chat completion chunks.
+
+    Yields the initial role chunk, one chunk per token and a final chunk with
+    finish_reason "stop". An upstream error is yielded as an OpenAI error
+    object and ends the stream. The ticket is released when the generator
+    finishes or is closed. Shared by the SSE and WebSocket transports.
+    """
+    try:
+        # Send initial chunk with role
+        initial_chunk = create_chat_completion_chunk("", model)
+        initial_chunk["choices"][0]["delta"]["role"] = "assistant"
+        yield initial_chunk
+
+        # Stream content from Kagi
+        for chunk in stream_with_fallback(prompt, kagi_models, access_log):
+            # Parse the SSE data
+            if chunk.startswith("data: "):
+                chunk_data = json.loads(chunk[6:])
+
+                if chunk_data.get("type") == "token":
+                    content = chunk_data.get("content", "")
+                    ticket.record_output(content)
+                    access_log.record_output(content)
+                    yield create_chat_completion_chunk(content, model)
+
+                elif chunk_data.get("type") == "done":
+                    # Send final chunk
+                    yield create_chat_completion_chunk(None, model, "stop")
+                    break
+
+                elif chunk_data.get("error"):
+                    ticket.error = True
+                    access_log.error = chunk_data.get("error")
+                    yield {
+                        "error": {
+                            "message": chunk_data.get("error"),
+                            "type": "api_error",
+                            "code": "internal_error",
+                        }
+                    }
+                    break
+
+    except Exception as e:
+        ticket.error = True
+        access_log.error = str(e)
+        raise
+    finally:
+        ticket.release()
+
+
+@app.before_request
+def start_access_log():
+    """Start collecting the access log entry for /v1/* routes"""
+    if not request.path.startswith("/v1/"):
+        return None
+
+    g.access_log = AccessLog(
+        request.method, request.path, request.headers.get("X-Request-ID")
+    )
+    g.access_log.bytes_in = request.content_length or 0
+    return None
+
+
+@app.before_request
+def identify_tenant():
+    """Resolve the API client for /v1/* routes from its bearer token"""
+    if not request.path.startswith("/v1/"):
+        return None
+
+    g.tenant = tenant_registry.identify(request.headers.get("Authorization"))
+    if g.tenant is not None:
+        g.access_log.tenant = g.tenant.name
+    else:
+        return jsonify(
+            {
+                "error": {
+                    "message": "Invalid or missing API key",
+                    "type": "invalid_request_error",
+                    "code": "invalid_api_key",
+                }
+            }
+        ), 401
+    return None
+
+
+@app.after_request
+def finish_access_log(response):
+    """Emit the access log entry once the response has been sent"""
+    access_log = g.get("access_log")
+    if access_log is None:
+        return response
+
+    access_log.status = response.status_code
+    response.headers["X-Request-ID"] = access_log.request_id
+    if response.is_streamed:
+        response.response = access_log.count_bytes(response.iter_encoded())
+    else:
+        access_log.bytes_out = response.content_length or 0
+    response.call_on_close(access_log.finish)
+    return response
+
+
+def acquire_ticket(stream):
+    """Wait for an execution slot for the current tenant"""
+    try:
+        return scheduler.acquire(
+            g.tenant, PRIORITY_INTERACTIVE if stream else PRIORITY_BULK
+        ), None
+    except RateLimited as e:
+        response = jsonify(
+            {
+                "error": {
+                    "message": str(e),
+                    "type": "rate_limit_error",
+                    "code": "rate_limit_exceeded",
+                }
+            }
+        )
+        response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+        return None, (response, 429)
+    except QueueTimeout as e:
+        return None, (
+            jsonify(
+                {
+                    "error": {
+                        "message": str(e),
+                        "type": "api_error",
+                        "code": "server_overloaded",
+                    }
+                }
+            ),
+            503,
+        )
+
+
+def record_completion(journal, chunks, access_log):
+    """
+    Run a streaming completion to the end, journaling its SSE events. The
+    access log entry is held back until the completion has finished, even if
+    the client disconnected earlier.
+    """
+    try:
+        for chunk in chunks:
+            journal.append(json.dumps(chunk))
+            if chunk.get("choices", [{}])[0].get("finish_reason") == "stop":
+                journal.append("[DONE]")
+    except Exception as e:
+        access_log.error = str(e)
+        _logger.exception(
+            "Streaming completion failed", extra={"fields": {"completion_id": journal.id}}
+        )
+        journal.append(
+            json.dumps(
+                {
+                    "error": {
+                        "message": str(e),
+                        "type": "api_error",
+                        "code": "internal_error",
+                    }
+                }
+            )
+        )
+    finally:
+        journal.finish()
+        access_log.finish()
+
+
+def stream_journal(journal, seq):
+    """Stream a completion's journaled events to the client, starting at seq"""
+
+    def generate():
+        try:
+            for event in journal.read(seq, STREAM_KEEPALIVE):
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                event_seq, data = event
+                yield f"id: {journal.id}:{event_seq}\ndata: {data}\n\n"
+        except JournalTruncated as e:
+            error_response = {
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error",
+                    "code": "stream_truncated",
+                }
+            }
+            yield f"data: {json.dumps(error_response)}\n\n"
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+def resume_chat_completion(last_event_id):
+    """Replay a journaled completion after the given SSE event id"""
+    completion_id, _, seq = last_event_id.rpartition(":")
+    journal = journals.get(completion_id)
+    if journal is None or journal.tenant != g.tenant.name or not seq.isdigit():
+        return jsonify(
+            {
+                "error": {
+                    "message": "Unknown or expired stream",
+                    "type": "invalid_request_error",
+                    "code": "stream_not_found",
+                }
+            }
+        ), 404
+
+    seq = int(seq) + 1
+    if not journal.can_replay_from(seq):
+        return jsonify(
+            {
+                "error": {
+                    "message": "Missed events are no longer available",
+                    "type": "invalid_request_error",
+                    "code": "stream_truncated",
+                }
+            }
+        ), 410
+
+    g.access_log.stream = True
+    return stream_journal(journal, seq)
+
+
 @app.route("/v1/chat/completions", methods=["POST"])
 def chat_completions():
     try:
+        # A reconnecting stream resumes the original completion
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id:
+            return resume_chat_completion(last_event_id)
+
         # Get request data
         data = request.get_json()
 
@@ -129,7 +518,28 @@ def chat_completions():
 
         # Get model and map it to Kagi model
         requested_model = data.get("model", DEFAULT_MODEL)
-        kagi_model = MODEL_MAPPING.get(requested_model, DEFAULT_MODEL)
+        if not isinstance(requested_model, str):
+            return jsonify(
+                {
+                    "error": {
+                        "message": "model must be a string",
+                        "type": "invalid_request_error",
+                        "code": "invalid_model",
+                    }
+                }
+            ), 400
+        try:
+            kagi_models = resolve_kagi_models(requested_model)
+        except ModelNotFound as e:
+            return jsonify(
+                {
+                    "error": {
+                        "message": str(e),
+                        "type": "invalid_request_error",
+                        "code": "model_not_found",
+                    }
+                }
+            ), 400
 
         # Convert messages to prompt
         prompt = convert_messages_to_prompt(messages)
@@ -137,91 +547,81 @@ def chat_completions():
         # Check if streaming is requested
         stream = data.get("stream", False)
 
-        if stream:
+        access_log = g.access_log
+        access_log.model = requested_model
+        access_log.stream = bool(stream)
 
-            def generate():
-                try:
-                    # Send initial chunk with role
-                    initial_chunk = create_chat_completion_chunk("")
-                    initial_chunk["choices"][0]["delta"]["role"] = "assistant"
-                    yield f"data: {json.dumps(initial_chunk)}\n\n"
-
-                    # Stream content from Kagi
-                    full_content = ""
-                    for chunk in stream_query(prompt, kagi_model):
-                        # Parse the SSE data
-                        if chunk.startswith("data: "):
-                            chunk_data = json.loads(chunk[6:])
-
-                            if chunk_data.get("type") == "token":
-                                content = chunk_data.get("content", "")
-                                full_content += content
-                                response_chunk = create_chat_completion_chunk(content)
-                                yield f"data: {json.dumps(response_chunk)}\n\n"
-
-                            elif chunk_data.get("type") == "done":
-                                # Send final chunk
-                                final_chunk = create_chat_completion_chunk(None, "stop")
-                                yield f"data: {json.dumps(final_chunk)}\n\n"
-                                yield "data: [DONE]\n\n"
-                                break
-
-                            elif chunk_data.get("error"):
-                                error_response = {
-                                    "error": {
-                                        "message": chunk_data.get("error"),
-                                        "type": "api_error",
-                                        "code": "internal_error",
-                                    }
-                                }
-                                yield f"data: {json.dumps(error_response)}\n\n"
-                                break
-
-                except Exception as e:
-                    raise
-                    # error_response = {
-                    #     'error': {
-                    #         'message': str(e),
-                    #         'type': 'api_error',
-                    #         'code': 'internal_error'
-                    #     }
-                    # }
-                    # yield f"data: {json.dumps(error_response)}\n\n"
-
-            return Response(
-                stream_with_context(generate()),
-                mimetype="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "X-Accel-Buffering": "no",
-                    "Connection": "keep-alive",
-                },
-            )
+        # Interactive (streaming) requests are scheduled ahead of bulk ones
+        ticket, error_response = acquire_ticket(stream)
+        if error_response:
+            return error_response
+
+        if stream:
+            chunk_model = data.get("model", get_model_mapping().get(DEFAULT_MODEL))
+
+            # The completion runs to the end in the background and is
+            # journaled, so a client that drops can resume with Last-Event-ID
+            journal = journals.create(g.tenant.name)
+            access_log.defer()
+            threading.Thread(
+                target=record_completion,
+                args=(
+                    journal,
+                    generate_chat_completion_chunks(
+                        prompt, kagi_models, chunk_model, ticket, access_log
+                    ),
+                    access_log,
+                ),
+                daemon=True,
+            ).start()
+            return stream_journal(journal, 0)
 
         else:
-            # Non-streaming response
-            full_content = ""
-            for chunk in stream_query(prompt, kagi_model):
-                if chunk.startswith("data: "):
-                    chunk_data = json.loads(chunk[6:])
-
-                    if chunk_data.get("type") == "token":
-                        full_content += chunk_data.get("content", "")
-
-                    elif chunk_data.get("type") == "final":
-                        full_content = chunk_data.get("content", "")
-
-                    elif chunk_data.get("error"):
-                        print(chunk_data)
-                        # return jsonify({
-                        #     'error': {
-                        #         'message': chunk_data.get('error'),
-                        #         'type': 'api_error',
-                        #         'code': 'internal_error'
-                        #     }
-                        # }), 500
-
-            return jsonify(create_chat_completion(full_content, requested_model))
+            # Non-streaming response: only Kagi's final reply is used, so
+            # tokens are not decoded and the response is sent as soon as the
+            # reply is done
+            try:
+                content, cleanup = complete_with_fallback(
+                    prompt, kagi_models, access_log
+                )
+                ticket.record_output(content)
+                access_log.record_output(content)
+            except KagiError as e:
+                ticket.error = True
+                access_log.error = str(e)
+                _logger.error(
+                    "Upstream error",
+                    extra={
+                        "fields": {
+                            "request_id": access_log.request_id,
+                            "error": str(e),
+                            "details": e.details,
+                        }
+                    },
+                )
+                return (
+                    jsonify(
+                        {
+                            "error": {
+                                "message": str(e),
+                                "type": "api_error",
+                                "code": e.code,
+                            }
+                        }
+                    ),
+                    e.status_code,
+                )
+            except Exception:
+                ticket.error = True
+                raise
+            finally:
+                ticket.release()
+
+            response = jsonify(create_chat_completion(content, requested_model))
+            # Closing the Kagi stream and deleting the thread happen in the
+            # background once the client has its reply
+            response.call_on_close(lambda: cleanup_executor.submit(cleanup))
+            return response
 
     except Exception as e:
         raise
@@ -237,20 +637,23 @@ def chat_completions():
 @app.route("/v1/models", methods=["GET"])
 def list_models():
     """List available models in OpenAI format"""
-    global MODEL_MAPPING
-
-    # Check if cache is stale or empty (cache for 6 hours)
-    cache_age = time.time() - _model_mapping_cache["timestamp"]
-    if cache_age > MODEL_MAPPING_CACHE_TTL or not _model_mapping_cache["mapping"]:
+    cached = state.get_json(MODEL_MAPPING_CACHE_KEY) or {"mapping": {}, "timestamp": 0}
+    mapping = cached["mapping"]
+
+    # Check if cache is stale or empty (cache for 6 hours). When another
+    # worker is already refreshing a stale cache, serve the stale copy.
+    cache_age = time.time() - cached["timestamp"]
+    # Only release the lease if this request took it, an empty cache is
+    # refreshed without one
+    leased = bool(mapping) and cache_age > MODEL_MAPPING_CACHE_TTL and (
+        state.acquire_lease(MODEL_MAPPING_REFRESH_LEASE, MODEL_MAPPING_REFRESH_LEASE_TTL)
+    )
+    if not mapping or leased:
         try:
-            MODEL_MAPPING = get_latest_model_mapping()
-            _model_mapping_cache["mapping"] = MODEL_MAPPING
-            _model_mapping_cache["timestamp"] = time.time()
+            mapping = refresh_model_mapping()
         except Exception as e:
             # If fetch fails and we have cached data, return stale data
-            if _model_mapping_cache["mapping"]:
-                MODEL_MAPPING = _model_mapping_cache["mapping"]
-            else:
+            if not mapping:
                 return jsonify(
                     {
                         "error": {
@@ -260,6 +663,9 @@ def list_models():
                         }
                     }
                 ), 503
+        finally:
+            if leased:
+                state.release_lease(MODEL_MAPPING_REFRESH_LEASE)
 
     models = [
         {
@@ -268,12 +674,41 @@ def list_models():
             "created": 1677532384,
             "owned_by": "kagi-proxy",
         }
-        for model_id in MODEL_MAPPING.keys()
+        for model_id in [*mapping.keys(), *router.virtual_model_ids()]
     ]
     models = sorted(models, key=lambda m: m["id"])
     return jsonify({"object": "list", "data": models})
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Per-tenant usage and latency metrics"""
+    # Tenant names and usage are private once API keys are required
+    if METRICS_KEY or tenant_registry.requires_auth:
+        authorization = request.headers.get("Authorization") or ""
+        if not METRICS_KEY or not hmac.compare_digest(
+            authorization.encode(), f"Bearer {METRICS_KEY}".encode()
+        ):
+            return jsonify(
+                {
+                    "error": {
+                        "message": "Invalid or missing metrics key",
+                        "type": "invalid_request_error",
+                        "code": "invalid_api_key",
+                    }
+                }
+            ), 401
+    return jsonify(
+        {
+            "scheduler": scheduler.stats(),
+            "tenants": tenant_registry.stats(),
+            "counters": state.counters(),
+            "models": router.stats(),
+            "logging": {"dropped_records": dropped_records()},
+        }
+    )
+
+
 @app.route("/health", methods=["GET"])
 def health_check():
     return jsonify({"status": "healthy"}), 200